@@ -1,5 +1,6 @@
 import json
 import string
+from functools import lru_cache
 
 import structlog
 from eth_utils import to_checksum_address
@@ -12,7 +13,16 @@ from raiden.lightclient.lightclientmessages.light_client_protocol_message import
 from raiden.messages import Message, LockedTransfer, SecretRequest, RevealSecret, Secret, Processed, Delivered, Unlock
 from raiden.storage.sqlite import SerializedSQLiteStorage
 from raiden.storage.wal import WriteAheadLog
-from typing import List
+from types import MappingProxyType
+from typing import Any, Callable, List, Mapping, Union
+
+# orjson is an opt-in extra, it is not part of the requirements. Installing it next to the
+# node gives the light client ack path a faster parser, without it the stdlib json is used.
+_json_loads: Callable[[str], Any]
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
 
 
 def build_light_client_protocol_message(identifier: int, message: Message, signed: bool, payment_id: int,
@@ -34,6 +44,25 @@ def build_light_client_protocol_message(identifier: int, message: Message, signe
     )
 
 
+# Field of each ack holding the identifier of the acknowledged message
+ACK_ID_ATTR = {Processed: "message_identifier", Delivered: "delivered_message_identifier"}
+
+
+@lru_cache(maxsize=256)
+def _parse_protocol_json(raw: str) -> Mapping[str, Any]:
+    # Acks for the same protocol message (delivered, processed, retries) keep parsing the same
+    # stored payload. The cached result is shared between callers, hence the read-only view.
+    # Number types in the result depend on the parser in use: orjson turns integers wider than
+    # 64 bits into floats. Only read fields such as `type` or `initiator` from it, never amounts.
+    return MappingProxyType(_json_loads(raw))
+
+
+@lru_cache(maxsize=64)
+def _order_for_ack(ack_parent_type: str, ack_type: str, is_delivered_from_initiator: bool = False) -> int:
+    # The set of (parent type, ack type, initiator) combinations is tiny, memoize the lookup
+    return LightClientMessageHandler.get_order_for_ack(ack_parent_type, ack_type, is_delivered_from_initiator)
+
+
 class LightClientMessageHandler:
     log = structlog.get_logger(__name__)  # pylint: disable=invalid-name
 
@@ -56,6 +85,15 @@ class LightClientMessageHandler:
                                                 payment_id, order)
         )
 
+    @classmethod
+    def store_light_client_protocol_message_if_absent(cls, identifier: int, message: Message, signed: bool,
+                                                      payment_id: int, order: int, wal: WriteAheadLog) -> bool:
+        return wal.storage.write_light_client_protocol_message_if_absent(
+            message,
+            build_light_client_protocol_message(identifier, message, signed,
+                                                payment_id, order)
+        )
+
     @classmethod
     def store_received_locked_transfer(cls, identifier: int, message: Message, signed: bool, payment_id: int,
                                        order: int,
@@ -132,77 +170,45 @@ class LightClientMessageHandler:
 
     @classmethod
     def store_lc_processed(cls, message: Processed, wal: WriteAheadLog):
-        # If exists for that payment, the same message by the order, then discard it.
-        message_identifier = message.message_identifier
-        # get first principal message by message identifier
-        protocol_message = LightClientMessageHandler.get_light_client_protocol_message_by_identifier(
-            message_identifier, wal)
-        json_message = None
-        if protocol_message.signed_message is None:
-            json_message = protocol_message.unsigned_message
-        else:
-            json_message = protocol_message.signed_message
-        json_message = json.loads(json_message)
-
-        order = LightClientMessageHandler.get_order_for_ack(json_message["type"], message.__class__.__name__.lower())
-        if order == -1:
-            cls.log.error("Unable to find principal message for {} {}: ".format(message.__class__.__name__,
-                                                                                message_identifier))
-        else:
-            exists = LightClientMessageHandler.is_light_client_protocol_message_already_stored_message_id(
-                message_identifier, protocol_message.light_client_payment_id, order, wal)
-            if not exists:
-                LightClientMessageHandler.store_light_client_protocol_message(
-                    message_identifier, message, True, protocol_message.light_client_payment_id, order,
-                    wal)
-            else:
-                cls.log.info("Message for lc already received, ignoring db storage")
+        cls.store_lc_ack(message, wal)
 
     @classmethod
     def store_lc_delivered(cls, message: Delivered, wal: WriteAheadLog):
-        # If exists for that payment, the same message by the order, then discard it.
-        message_identifier = message.delivered_message_identifier
-        # get first by message identifier
-        protocol_message = LightClientMessageHandler.get_light_client_protocol_message_by_identifier(
-            message_identifier, wal)
-        json_message = None
-        if protocol_message.signed_message is None:
-            json_message = protocol_message.unsigned_message
-        else:
-            json_message = protocol_message.signed_message
-
-        json_message = json.loads(json_message)
-
-        first_message_is_lt = protocol_message.message_order == 1
-        is_delivered_from_initiator = True
-        delivered_sender = message.sender
-        if not first_message_is_lt:
-            # get lt to get the payment identifier
-            locked_transfer = LightClientMessageHandler.get_light_client_payment_locked_transfer(
-                protocol_message.light_client_payment_id, wal)
-            signed_locked_transfer_message = json.loads(locked_transfer.signed_message)
-            payment_initiator = signed_locked_transfer_message["initiator"]
-            if to_checksum_address(delivered_sender) != to_checksum_address(payment_initiator):
-                is_delivered_from_initiator = False
-        else:
-            # message is the lt
-            payment_initiator = json_message["initiator"]
-            if to_checksum_address(delivered_sender) != to_checksum_address(payment_initiator):
-                is_delivered_from_initiator = False
+        cls.store_lc_ack(message, wal)
 
-        order = LightClientMessageHandler.get_order_for_ack(json_message["type"], message.__class__.__name__.lower(),
-                                                            is_delivered_from_initiator)
+    @classmethod
+    def store_lc_ack(cls, message: Union[Processed, Delivered], wal: WriteAheadLog):
+        # If exists for that payment, the same message by the order, then discard it.
+        message_type = type(message)
+        message_identifier = getattr(message, ACK_ID_ATTR[message_type])
+        # get first principal message by message identifier
+        protocol_message = _get_protocol_message_by_identifier(message_identifier, wal)
+        signed_message = protocol_message.signed_message
+        raw_message = protocol_message.unsigned_message if signed_message is None else signed_message
+        json_message = _parse_protocol_json(raw_message)
+        payment_id = protocol_message.light_client_payment_id
+
+        # Only the order of a delivered depends on who sent it
+        is_delivered_from_initiator = False
+        if message_type is Delivered:
+            if protocol_message.message_order == 1:
+                # message is the lt
+                payment_initiator = json_message["initiator"]
+            else:
+                # get lt to get the payment identifier
+                locked_transfer = _get_payment_locked_transfer(payment_id, wal)
+                payment_initiator = _parse_protocol_json(locked_transfer.signed_message)["initiator"]
+            is_delivered_from_initiator = \
+                to_checksum_address(message.sender) == to_checksum_address(payment_initiator)
+
+        message_type_name = message_type.__name__
+        order = _order_for_ack(json_message["type"], message_type_name.lower(), is_delivered_from_initiator)
         if order == -1:
-            cls.log.error("Unable to find principal message for {} {}: ".format(message.__class__.__name__,
-                                                                                message_identifier))
+            cls.log.error("Unable to find principal message for {} {}: ".format(message_type_name, message_identifier))
         else:
-            exists = LightClientMessageHandler.is_light_client_protocol_message_already_stored_message_id(
-                message_identifier, protocol_message.light_client_payment_id, order, wal)
-            if not exists:
-                LightClientMessageHandler.store_light_client_protocol_message(
-                    message_identifier, message, True, protocol_message.light_client_payment_id, order,
-                    wal)
-            else:
+            stored = _store_protocol_message_if_absent(
+                message_identifier, message, True, payment_id, order, wal)
+            if not stored:
                 cls.log.info("Message for lc already received, ignoring db storage")
 
     @classmethod
@@ -226,3 +232,9 @@ class LightClientMessageHandler:
                                                      latest_update_balance_proof_data[0]
                                                      )
         return None
+
+
+# Bound once, these are called for every light client ack
+_get_protocol_message_by_identifier = LightClientMessageHandler.get_light_client_protocol_message_by_identifier
+_get_payment_locked_transfer = LightClientMessageHandler.get_light_client_payment_locked_transfer
+_store_protocol_message_if_absent = LightClientMessageHandler.store_light_client_protocol_message_if_absent
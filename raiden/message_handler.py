@@ -1,13 +1,15 @@
 import structlog
 import json
 
+from cachetools import LRUCache
 from eth_utils import to_checksum_address, encode_hex
 
 from raiden.constants import EMPTY_SECRET, TEST_PAYMENT_ID
-from raiden.lightclient.light_client_message_handler import LightClientMessageHandler
+from raiden.lightclient.light_client_message_handler import ACK_ID_ATTR, LightClientMessageHandler
 from raiden.lightclient.light_client_service import LightClientService
 from raiden.messages import (
     Delivered,
+    EnvelopeMessage,
     LockedTransfer,
     LockExpired,
     Message,
@@ -30,121 +32,171 @@ from raiden.transfer.mediated_transfer.state_change import (
     ReceiveTransferRefund,
     ReceiveTransferRefundCancelRoute,
     ReceiveSecretRequestLight, ReceiveSecretRevealLight)
-from raiden.transfer.state import balanceproof_from_envelope
+from raiden.transfer.state import ChainState, RouteState, balanceproof_from_envelope
 from raiden.transfer.state_change import ReceiveDelivered, ReceiveProcessed, ReceiveUnlock, ReceiveUnlockLight
 from raiden.utils import pex, random_secret
-from raiden.utils.typing import MYPY_ANNOTATION, InitiatorAddress, PaymentAmount, TokenNetworkID, Union
+from raiden.utils.typing import (
+    Address,
+    Dict,
+    InitiatorAddress,
+    List,
+    Optional,
+    PaymentAmount,
+    SecretHash,
+    TokenNetworkID,
+    Tuple,
+    Union,
+)
 
 log = structlog.get_logger(__name__)  # pylint: disable=invalid-name
 
+# Processed and Delivered only differ by the field holding the acknowledged message
+# identifier, see `ACK_ID_ATTR`, and the state change they produce.
+_ACK_STATE_CHANGE = {Processed: ReceiveProcessed, Delivered: ReceiveDelivered}
 
-class MessageHandler:
-    def on_message(self, raiden: RaidenService, message: Message, is_light_client: bool = False) -> None:
-        # pylint: disable=unidiomatic-typecheck
-        print("On received message " + str(type(message)))
+# A registered secret stays known forever, so positive answers from the secret
+# registry are kept until evicted. Negative answers are not cached, the secret may be
+# registered at any block.
+_registered_secrets: LRUCache = LRUCache(maxsize=4096)
 
-        if type(message) == SecretRequest:
-            assert isinstance(message, SecretRequest), MYPY_ANNOTATION
-            self.handle_message_secretrequest(raiden, message, is_light_client)
 
-        elif type(message) == RevealSecret:
-            assert isinstance(message, RevealSecret), MYPY_ANNOTATION
-            self.handle_message_revealsecret(raiden, message, is_light_client)
+def is_secret_registered_cached(raiden: RaidenService, secrethash: SecretHash) -> bool:
+    """ `is_secret_registered` against the latest block, answered from a cache
+    for secrethashes already known to be registered.
+    """
+    secret_registry = raiden.default_secret_registry
+    key = (secret_registry.address, secrethash)
+    if key in _registered_secrets:
+        return True
 
-        elif type(message) == Unlock:
-            assert isinstance(message, Unlock), MYPY_ANNOTATION
-            self.handle_message_unlock(raiden, message, is_light_client)
+    registered = secret_registry.is_secret_registered(
+        secrethash=secrethash, block_identifier="latest"
+    )
+    if registered:
+        _registered_secrets[key] = True
+    return registered
 
-        elif type(message) == LockExpired:
-            assert isinstance(message, LockExpired), MYPY_ANNOTATION
-            self.handle_message_lockexpired(raiden, message)
 
-        elif type(message) == RefundTransfer:
-            assert isinstance(message, RefundTransfer), MYPY_ANNOTATION
-            self.handle_message_refundtransfer(raiden, message)
+def _is_balance_proof_applied(
+    chain_state: ChainState, node_address: Address, message: EnvelopeMessage
+) -> bool:
+    """ True if the partner's balance proof in the node's channel already covers `message`.
 
-        elif type(message) == LockedTransfer:
-            assert isinstance(message, LockedTransfer), MYPY_ANNOTATION
-            self.handle_message_lockedtransfer(raiden, message)
+    The channel only accepts the balance proof with the next nonce, so such a message is a
+    retransmission the state machine would reject. A message received before its channel
+    is known, or for a light client channel, is not covered and is handled as usual.
+    """
+    token_network = views.get_token_network_by_identifier(
+        chain_state, TokenNetworkID(message.token_network_address)
+    )
+    if token_network is None:
+        return False
 
-        elif type(message) == Delivered:
-            assert isinstance(message, Delivered), MYPY_ANNOTATION
-            self.handle_message_delivered(raiden, message, is_light_client)
+    channel_state = token_network.channelidentifiers_to_channels.get(node_address, {}).get(
+        message.channel_identifier
+    )
+    if channel_state is None:
+        return False
 
-        elif type(message) == Processed:
-            assert isinstance(message, Processed), MYPY_ANNOTATION
-            self.handle_message_processed(raiden, message, is_light_client)
-        else:
-            log.error("Unknown message cmdid {}".format(message.cmdid))
-
-    @staticmethod
-    def handle_message_secretrequest(raiden: RaidenService, message: SecretRequest,
-                                     is_light_client: bool = False) -> None:
-
-        if is_light_client:
-            secret_request_light = ReceiveSecretRequestLight(
-                message.payment_identifier,
-                message.amount,
-                message.expiration,
-                message.secrethash,
-                message.sender,
-                message
-            )
-            raiden.handle_and_track_state_change(secret_request_light)
-        else:
-            secret_request = ReceiveSecretRequest(
-                message.payment_identifier,
-                message.amount,
-                message.expiration,
-                message.secrethash,
-                message.sender,
-            )
-            raiden.handle_and_track_state_change(secret_request)
-
-    @staticmethod
-    def handle_message_revealsecret(raiden: RaidenService, message: RevealSecret, is_light_client=False) -> None:
-        if is_light_client:
-            state_change = ReceiveSecretRevealLight(message.secret, message.sender, message)
-            raiden.handle_and_track_state_change(state_change)
-        else:
-            state_change = ReceiveSecretReveal(message.secret, message.sender)
-            raiden.handle_and_track_state_change(state_change)
-
-    @staticmethod
-    def handle_message_unlock(raiden: RaidenService, message: Unlock, is_light_client=False) -> None:
-        balance_proof = balanceproof_from_envelope(message)
-        if is_light_client:
-            state_change = ReceiveUnlockLight(
-                message_identifier=message.message_identifier,
-                secret=message.secret,
-                balance_proof=balance_proof,
-                signed_unlock=message
-            )
-            raiden.handle_and_track_state_change(state_change)
-        else:
-            state_change = ReceiveUnlock(
-                message_identifier=message.message_identifier,
-                secret=message.secret,
-                balance_proof=balance_proof,
-            )
-            raiden.handle_and_track_state_change(state_change)
-
-    @staticmethod
-    def handle_message_lockexpired(raiden: RaidenService, message: LockExpired) -> None:
-        balance_proof = balanceproof_from_envelope(message)
-        state_change = ReceiveLockExpired(
-            balance_proof=balance_proof,
-            secrethash=message.secrethash,
-            message_identifier=message.message_identifier,
+    balance_proof = channel_state.partner_state.balance_proof
+    if balance_proof is None or message.nonce > balance_proof.nonce:
+        return False
+
+    log.debug(
+        "Dropping already applied message",
+        message_type=type(message).__name__,
+        sender=pex(message.sender),
+        token_network=pex(message.token_network_address),
+        channel_identifier=message.channel_identifier,
+        nonce=message.nonce,
+        partner_nonce=balance_proof.nonce,
+    )
+    return True
+
+
+def _handle_secretrequest(raiden: RaidenService, message: SecretRequest,
+                          is_light_client: bool = False) -> None:
+
+    if is_light_client:
+        secret_request_light = ReceiveSecretRequestLight(
+            message.payment_identifier,
+            message.amount,
+            message.expiration,
+            message.secrethash,
+            message.sender,
+            message
         )
+        raiden.handle_and_track_state_change(secret_request_light)
+    else:
+        secret_request = ReceiveSecretRequest(
+            message.payment_identifier,
+            message.amount,
+            message.expiration,
+            message.secrethash,
+            message.sender,
+        )
+        raiden.handle_and_track_state_change(secret_request)
+
+
+def _handle_revealsecret(raiden: RaidenService, message: RevealSecret, is_light_client: bool = False) -> None:
+    if is_light_client:
+        state_change = ReceiveSecretRevealLight(message.secret, message.sender, message)
+        raiden.handle_and_track_state_change(state_change)
+    else:
+        state_change = ReceiveSecretReveal(message.secret, message.sender)
+        raiden.handle_and_track_state_change(state_change)
+
+
+def _handle_unlock(raiden: RaidenService, message: Unlock, is_light_client: bool = False) -> None:
+    chain_state = views.state_from_raiden(raiden)
+    if _is_balance_proof_applied(chain_state, raiden.address, message):
+        return
+
+    balance_proof = balanceproof_from_envelope(message)
+    if is_light_client:
+        state_change = ReceiveUnlockLight(
+            message.message_identifier,
+            message.secret,
+            balance_proof,
+            message
+        )
+        raiden.handle_and_track_state_change(state_change)
+    else:
+        state_change = ReceiveUnlock(message.message_identifier, message.secret, balance_proof)
         raiden.handle_and_track_state_change(state_change)
 
-    @staticmethod
-    def handle_message_refundtransfer(raiden: RaidenService, message: RefundTransfer) -> None:
-        token_network_address = message.token_network_address
-        from_transfer = lockedtransfersigned_from_message(message)
-        chain_state = views.state_from_raiden(raiden)
 
+def _handle_lockexpired(raiden: RaidenService, message: LockExpired) -> None:
+    chain_state = views.state_from_raiden(raiden)
+    if _is_balance_proof_applied(chain_state, raiden.address, message):
+        return
+
+    balance_proof = balanceproof_from_envelope(message)
+    state_change = ReceiveLockExpired(balance_proof, message.secrethash, message.message_identifier)
+    raiden.handle_and_track_state_change(state_change)
+
+
+def _handle_refundtransfer(raiden: RaidenService, message: RefundTransfer) -> None:
+    chain_state = views.state_from_raiden(raiden)
+    if _is_balance_proof_applied(chain_state, raiden.address, message):
+        return
+
+    token_network_address = message.token_network_address
+    from_transfer = lockedtransfersigned_from_message(message)
+
+    # Look the transfer task up once, both the role and the secret derive from it
+    secrethash = from_transfer.lock.secrethash
+    transfer_task = views.get_transfer_task(chain_state, secrethash)
+    role = views.role_from_transfer_task(transfer_task) if transfer_task else None
+    is_initiator = role == "initiator"
+
+    routes: List[RouteState]
+    # We currently don't allow multi routes if the initiator does not
+    # hold the secret. In such case we remove all other possible routes
+    # which allow the API call to return with with an error message.
+    if is_initiator and views.secret_from_transfer_task(transfer_task, secrethash) == EMPTY_SECRET:
+        routes = list()
+    else:
         # FIXME: Shouldn't request routes here
         routes, _ = get_best_routes(
             chain_state=chain_state,
@@ -158,71 +210,101 @@ class MessageHandler:
             privkey=raiden.privkey,
         )
 
-        role = views.get_transfer_role(
-            chain_state=chain_state, secrethash=from_transfer.lock.secrethash
+    state_change: StateChange
+    if is_initiator:
+        secret = random_secret()
+        state_change = ReceiveTransferRefundCancelRoute(
+            routes=routes, transfer=from_transfer, secret=secret
         )
+    else:
+        state_change = ReceiveTransferRefund(transfer=from_transfer, routes=routes)
 
-        state_change: StateChange
-        if role == "initiator":
-            old_secret = views.get_transfer_secret(chain_state, from_transfer.lock.secrethash)
-            # We currently don't allow multi routes if the initiator does not
-            # hold the secret. In such case we remove all other possible routes
-            # which allow the API call to return with with an error message.
-            if old_secret == EMPTY_SECRET:
-                routes = list()
-
-            secret = random_secret()
-            state_change = ReceiveTransferRefundCancelRoute(
-                routes=routes, transfer=from_transfer, secret=secret
-            )
-        else:
-            state_change = ReceiveTransferRefund(transfer=from_transfer, routes=routes)
+    raiden.handle_and_track_state_change(state_change)
 
-        raiden.handle_and_track_state_change(state_change)
 
-    @staticmethod
-    def handle_message_lockedtransfer(raiden: RaidenService, message: LockedTransfer) -> None:
-        secrethash = message.lock.secrethash
-        # We must check if the secret was registered against the latest block,
-        # even if the block is forked away and the transaction that registers
-        # the secret is removed from the blockchain. The rationale here is that
-        # someone else does know the secret, regardless of the chain state, so
-        # the node must not use it to start a payment.
-        #
-        # For this particular case, it's preferable to use `latest` instead of
-        # having a specific block_hash, because it's preferable to know if the secret`
-        # was ever known, rather than having a consistent view of the blockchain.
-        registered = raiden.default_secret_registry.is_secret_registered(
-            secrethash=secrethash, block_identifier="latest"
+def _handle_lockedtransfer(raiden: RaidenService, message: LockedTransfer) -> None:
+    chain_state = views.state_from_raiden(raiden)
+    if _is_balance_proof_applied(chain_state, raiden.address, message):
+        return
+
+    secrethash = message.lock.secrethash
+    # We must check if the secret was registered against the latest block,
+    # even if the block is forked away and the transaction that registers
+    # the secret is removed from the blockchain. The rationale here is that
+    # someone else does know the secret, regardless of the chain state, so
+    # the node must not use it to start a payment.
+    #
+    # For this particular case, it's preferable to use `latest` instead of
+    # having a specific block_hash, because it's preferable to know if the secret`
+    # was ever known, rather than having a consistent view of the blockchain.
+    registered = is_secret_registered_cached(raiden, secrethash)
+    if registered:
+        log.warning(
+            "Ignoring received locked transfer, secret already registered in the secret registry",
+            secrethash=pex(secrethash),
         )
-        if registered:
-            log.warning(
-                f"Ignoring received locked transfer with secrethash {pex(secrethash)} "
-                f"since it is already registered in the secret registry"
-            )
-            return
+        return
+
+    # TODO marcosmartinez7: unimplemented mediated transfer for light clients
+    is_handled_light_client = LightClientService.is_handled_lc(to_checksum_address(message.recipient),
+                                                               raiden.wal)
 
-        # TODO marcosmartinez7: unimplemented mediated transfer for light clients
-        is_handled_light_client = LightClientService.is_handled_lc(to_checksum_address(message.recipient),
-                                                                   raiden.wal)
+    if message.target == raiden.address:
+        raiden.target_mediated_transfer(message)
+    elif is_handled_light_client:
+        raiden.target_mediated_transfer_light(message)
+    else:
+        raiden.mediate_mediated_transfer(message)
 
-        if message.target == raiden.address:
-            raiden.target_mediated_transfer(message)
-        elif is_handled_light_client:
-            raiden.target_mediated_transfer_light(message)
+
+def _handle_ack(raiden: RaidenService, message: Union[Processed, Delivered], is_light_client: bool = False) -> None:
+    message_type = type(message)
+    message_identifier = getattr(message, ACK_ID_ATTR[message_type])
+    raiden.handle_and_track_state_change(_ACK_STATE_CHANGE[message_type](message.sender, message_identifier))
+    if is_light_client:
+        LightClientMessageHandler.store_lc_ack(message, raiden.wal)
+
+
+class MessageHandler:
+    # Maps the cmdid of each message type to the name of its handler and whether the
+    # handler takes the `is_light_client` flag. Handlers are resolved by name on the
+    # instance, so subclasses and mocks overriding a single handler still work. The
+    # table also stands in for a `match` on the message class, which needs Python 3.10
+    # while the package still supports 3.7.
+    _DISPATCH: Dict[Optional[int], Tuple[str, bool]] = {
+        SecretRequest.cmdid: ("handle_message_secretrequest", True),
+        RevealSecret.cmdid: ("handle_message_revealsecret", True),
+        Unlock.cmdid: ("handle_message_unlock", True),
+        LockExpired.cmdid: ("handle_message_lockexpired", False),
+        RefundTransfer.cmdid: ("handle_message_refundtransfer", False),
+        LockedTransfer.cmdid: ("handle_message_lockedtransfer", False),
+        Delivered.cmdid: ("handle_message_delivered", True),
+        Processed.cmdid: ("handle_message_processed", True),
+    }
+
+    def on_message(self, raiden: RaidenService, message: Message, is_light_client: bool = False) -> None:
+        cmdid = message.cmdid
+        log.debug("On received message", cmdid=cmdid)
+
+        entry = self._DISPATCH.get(cmdid)
+        if entry is None:
+            log.error("Unknown message cmdid {}".format(cmdid))
+            return
+
+        handler_name, accepts_light_client = entry
+        handler = getattr(self, handler_name)
+        if accepts_light_client:
+            handler(raiden, message, is_light_client)
         else:
-            raiden.mediate_mediated_transfer(message)
-
-    @classmethod
-    def handle_message_processed(cls, raiden: RaidenService, message: Processed, is_light_client: bool = False) -> None:
-        processed = ReceiveProcessed(message.sender, message.message_identifier)
-        raiden.handle_and_track_state_change(processed)
-        if is_light_client:
-            LightClientMessageHandler.store_lc_processed(message, raiden.wal)
-
-    @classmethod
-    def handle_message_delivered(cls, raiden: RaidenService, message: Delivered, is_light_client: bool = False) -> None:
-        delivered = ReceiveDelivered(message.sender, message.delivered_message_identifier)
-        raiden.handle_and_track_state_change(delivered)
-        if is_light_client:
-            LightClientMessageHandler.store_lc_delivered(message, raiden.wal)
+            handler(raiden, message)
+
+    # Facade over the module level handlers, kept for callers and tests that use or
+    # override them on a MessageHandler instance.
+    handle_message_secretrequest = staticmethod(_handle_secretrequest)
+    handle_message_revealsecret = staticmethod(_handle_revealsecret)
+    handle_message_unlock = staticmethod(_handle_unlock)
+    handle_message_lockexpired = staticmethod(_handle_lockexpired)
+    handle_message_refundtransfer = staticmethod(_handle_refundtransfer)
+    handle_message_lockedtransfer = staticmethod(_handle_lockedtransfer)
+    handle_message_processed = staticmethod(_handle_ack)
+    handle_message_delivered = staticmethod(_handle_ack)
@@ -199,6 +199,38 @@ class SQLiteStorage:
             last_id = cursor.lastrowid
         return last_id
 
+    def _insert_light_client_protocol_message_if_absent(self, msg_dto) -> bool:
+        """ Insert the message unless one with the same identifier, payment and order is
+        already stored. Returns whether the message was inserted.
+        """
+        identifier = str(msg_dto.identifier)
+        payment_id = str(msg_dto.light_client_payment_id)
+        with self.write_lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO light_client_protocol_message("
+                "identifier, "
+                "message_order, "
+                "unsigned_message, "
+                "signed_message, "
+                "light_client_payment_id "
+                ")"
+                "SELECT ?, ?, ?, ?, ? "
+                "WHERE NOT EXISTS ("
+                "SELECT 1 FROM light_client_protocol_message "
+                "WHERE identifier = ? AND light_client_payment_id = ? AND message_order = ?"
+                ")",
+                (identifier,
+                 msg_dto.message_order,
+                 msg_dto.unsigned_message,
+                 msg_dto.signed_message,
+                 payment_id,
+                 identifier,
+                 payment_id,
+                 msg_dto.message_order,
+                 ),
+            )
+        return cursor.rowcount > 0
+
     def write_light_client_protocol_messages(self, msg_dtos):
         with self.write_lock, self.conn:
             cursor = self.conn.executemany(
@@ -1422,6 +1454,21 @@ class SerializedSQLiteStorage(SQLiteStorage):
             msg_dto.unsigned_message = serialized_data
         return super().write_light_client_protocol_message(msg_dto)
 
+    def write_light_client_protocol_message_if_absent(self, new_message, msg_dto) -> bool:
+        # Most acks are retries of an already stored one, don't serialize those. The insert
+        # checks again, so a concurrent write of the same message is still not duplicated.
+        if self.is_light_client_protocol_message_already_stored_with_message_id(
+            msg_dto.identifier, msg_dto.light_client_payment_id, msg_dto.message_order
+        ):
+            return False
+
+        serialized_data = self.serializer.serialize(new_message)
+        if msg_dto.is_signed:
+            msg_dto.signed_message = serialized_data
+        else:
+            msg_dto.unsigned_message = serialized_data
+        return self._insert_light_client_protocol_message_if_absent(msg_dto)
+
     def write_state_change(self, state_change, log_time):
         serialized_data = self.serializer.serialize(state_change)
         return super().write_state_change(serialized_data, log_time)
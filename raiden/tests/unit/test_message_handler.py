@@ -0,0 +1,207 @@
+from unittest.mock import Mock, patch
+
+from raiden.constants import EMPTY_MERKLE_ROOT, EMPTY_SECRET, PROTOCOL_VERSION
+from raiden.message_handler import (
+    MessageHandler,
+    _is_balance_proof_applied,
+    is_secret_registered_cached,
+)
+from raiden.messages import Delivered, LockExpired, Ping, Processed, Unlock
+from raiden.tests.utils.factories import (
+    make_address,
+    make_keccak_hash,
+    make_message_identifier,
+    make_secret,
+    make_signer,
+)
+from raiden.transfer.mediated_transfer.state import LockedTransferSignedState
+from raiden.transfer.mediated_transfer.state_change import ReceiveTransferRefundCancelRoute
+
+
+def make_signed_unlock(nonce: int) -> Unlock:
+    unlock = Unlock(
+        chain_id=33,
+        message_identifier=make_message_identifier(),
+        payment_identifier=1,
+        secret=make_secret(),
+        nonce=nonce,
+        token_network_address=make_address(),
+        channel_identifier=1,
+        transferred_amount=10,
+        locked_amount=0,
+        locksroot=EMPTY_MERKLE_ROOT,
+    )
+    unlock.sign(make_signer())
+    return unlock
+
+
+def make_raiden_with_secret_registry(registered: bool):
+    raiden = Mock()
+    raiden.default_secret_registry.address = make_address()
+    raiden.default_secret_registry.is_secret_registered.return_value = registered
+    return raiden
+
+
+def test_is_secret_registered_cached_remembers_registered_secrets():
+    raiden = make_raiden_with_secret_registry(registered=True)
+    secrethash = make_keccak_hash()
+
+    assert is_secret_registered_cached(raiden, secrethash)
+    assert is_secret_registered_cached(raiden, secrethash)
+
+    raiden.default_secret_registry.is_secret_registered.assert_called_once_with(
+        secrethash=secrethash, block_identifier="latest"
+    )
+
+
+def test_is_secret_registered_cached_queries_unregistered_secrets_every_time():
+    raiden = make_raiden_with_secret_registry(registered=False)
+    secrethash = make_keccak_hash()
+
+    assert not is_secret_registered_cached(raiden, secrethash)
+    assert not is_secret_registered_cached(raiden, secrethash)
+    assert raiden.default_secret_registry.is_secret_registered.call_count == 2
+
+    # A secret registered in the meantime is seen right away
+    raiden.default_secret_registry.is_secret_registered.return_value = True
+    assert is_secret_registered_cached(raiden, secrethash)
+    assert raiden.default_secret_registry.is_secret_registered.call_count == 3
+
+
+GET_TOKEN_NETWORK = "raiden.transfer.views.get_token_network_by_identifier"
+
+
+def make_token_network_with_channel(node_address, partner_nonce):
+    channel_state = Mock()
+    channel_state.partner_state.balance_proof = (
+        None if partner_nonce is None else Mock(nonce=partner_nonce)
+    )
+    token_network = Mock()
+    token_network.channelidentifiers_to_channels = {node_address: {1: channel_state}}
+    return token_network
+
+
+def test_is_balance_proof_applied_only_covers_already_accepted_nonces():
+    chain_state = Mock()
+    node_address = make_address()
+    token_network = make_token_network_with_channel(node_address, partner_nonce=2)
+
+    with patch(GET_TOKEN_NETWORK, return_value=token_network):
+        assert _is_balance_proof_applied(chain_state, node_address, make_signed_unlock(nonce=1))
+        assert _is_balance_proof_applied(chain_state, node_address, make_signed_unlock(nonce=2))
+        # The next nonce must reach the state machine
+        unlock = make_signed_unlock(nonce=3)
+        assert not _is_balance_proof_applied(chain_state, node_address, unlock)
+
+    token_network = make_token_network_with_channel(node_address, partner_nonce=None)
+    with patch(GET_TOKEN_NETWORK, return_value=token_network):
+        unlock = make_signed_unlock(nonce=1)
+        assert not _is_balance_proof_applied(chain_state, node_address, unlock)
+
+
+def test_is_balance_proof_applied_lets_messages_for_unknown_channels_through():
+    chain_state = Mock()
+    node_address = make_address()
+    unlock = make_signed_unlock(nonce=2)
+    token_network = make_token_network_with_channel(make_address(), partner_nonce=5)
+
+    with patch(GET_TOKEN_NETWORK, return_value=token_network):
+        assert not _is_balance_proof_applied(chain_state, node_address, unlock)
+
+    with patch(GET_TOKEN_NETWORK, return_value=None):
+        assert not _is_balance_proof_applied(chain_state, node_address, unlock)
+
+
+def test_handle_message_lockedtransfer_drops_already_applied_transfers():
+    raiden = Mock(address=make_address())
+    locked_transfer = Mock(
+        nonce=2, channel_identifier=1, sender=make_address(), token_network_address=make_address()
+    )
+    token_network = make_token_network_with_channel(raiden.address, partner_nonce=2)
+
+    with patch(GET_TOKEN_NETWORK, return_value=token_network):
+        MessageHandler.handle_message_lockedtransfer(raiden, locked_transfer)
+
+    # Neither the secret registry nor the state machine see the retransmission
+    assert not raiden.default_secret_registry.is_secret_registered.called
+    assert not raiden.target_mediated_transfer.called
+    assert not raiden.mediate_mediated_transfer.called
+
+
+def test_handle_message_unlock_accepts_is_light_client_keyword():
+    raiden = Mock(address=make_address())
+    unlock = make_signed_unlock(nonce=2)
+
+    with patch(GET_TOKEN_NETWORK, return_value=None):
+        MessageHandler.handle_message_unlock(raiden, unlock, is_light_client=True)
+
+    assert raiden.handle_and_track_state_change.call_count == 1
+
+
+def test_on_message_dispatches_acks_to_overridable_handlers():
+    raiden = Mock(address=make_address())
+    processed = Processed(message_identifier=make_message_identifier())
+    delivered = Delivered(delivered_message_identifier=make_message_identifier())
+
+    message_handler = MessageHandler()
+    message_handler.handle_message_processed = Mock()
+    message_handler.handle_message_delivered = Mock()
+
+    message_handler.on_message(raiden, processed, is_light_client=True)
+    message_handler.on_message(raiden, delivered)
+
+    message_handler.handle_message_processed.assert_called_once_with(raiden, processed, True)
+    message_handler.handle_message_delivered.assert_called_once_with(raiden, delivered, False)
+    assert not raiden.handle_and_track_state_change.called
+
+
+def test_handle_refundtransfer_skips_routing_for_initiator_without_secret():
+    raiden = Mock(address=make_address())
+    message = Mock(nonce=2)
+    from_transfer = Mock(spec=LockedTransferSignedState)
+
+    with patch(GET_TOKEN_NETWORK, return_value=None), patch(
+        "raiden.message_handler.lockedtransfersigned_from_message", return_value=from_transfer
+    ), patch("raiden.transfer.views.get_transfer_task"), patch(
+        "raiden.transfer.views.role_from_transfer_task", return_value="initiator"
+    ), patch(
+        "raiden.transfer.views.secret_from_transfer_task", return_value=EMPTY_SECRET
+    ), patch(
+        "raiden.message_handler.get_best_routes"
+    ) as get_best_routes:
+        MessageHandler.handle_message_refundtransfer(raiden, message)
+
+    assert not get_best_routes.called
+    (state_change,), _ = raiden.handle_and_track_state_change.call_args
+    assert isinstance(state_change, ReceiveTransferRefundCancelRoute)
+    assert state_change.transfer is from_transfer
+    assert state_change.routes == []
+
+
+def test_on_message_logs_unknown_messages_without_calling_a_handler():
+    raiden = Mock(address=make_address())
+    message_handler = MessageHandler()
+    for handler_name, _ in MessageHandler._DISPATCH.values():
+        setattr(message_handler, handler_name, Mock())
+
+    with patch("raiden.message_handler.log") as log:
+        message_handler.on_message(
+            raiden, Ping(nonce=1, current_protocol_version=PROTOCOL_VERSION)
+        )
+        message_handler.on_message(raiden, Mock(cmdid=None))
+
+    assert log.error.call_count == 2
+    for handler_name, _ in MessageHandler._DISPATCH.values():
+        assert not getattr(message_handler, handler_name).called
+    assert not raiden.handle_and_track_state_change.called
+
+
+def test_on_message_dispatches_lock_expired_without_light_client_flag():
+    raiden = Mock(address=make_address())
+    lock_expired = Mock(cmdid=LockExpired.cmdid)
+    message_handler = MessageHandler()
+    message_handler.handle_message_lockexpired = Mock()
+
+    message_handler.on_message(raiden, lock_expired, is_light_client=True)
+
+    message_handler.handle_message_lockexpired.assert_called_once_with(raiden, lock_expired)
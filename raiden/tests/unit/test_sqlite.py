@@ -4,6 +4,14 @@ from datetime import datetime, timedelta
 from pathlib import Path
 from unittest.mock import patch
 
+from raiden.lightclient.lightclientmessages.light_client_payment import (
+    LightClientPayment,
+    LightClientPaymentStatus,
+)
+from raiden.lightclient.lightclientmessages.light_client_protocol_message import (
+    DbLightClientProtocolMessage,
+    LightClientProtocolMessage,
+)
 from raiden.messages import Lock
 from raiden.storage.serialize import JSONSerializer
 from raiden.storage.sqlite import SerializedSQLiteStorage, SQLiteStorage
@@ -410,3 +418,44 @@ def test_batch_query_event_records():
     for events_batch in events_batch_query:
         events.extend(events_batch)
     assert len(events) == 2
+
+
+def test_insert_light_client_protocol_message_if_absent():
+    storage = SQLiteStorage(":memory:")
+    light_client_address = factories.make_checksum_address()
+    storage.save_light_client(
+        address=light_client_address,
+        encrypt_signed_password="password",
+        api_key="api_key",
+        encrypt_signed_display_name="display_name",
+        encrypt_signed_seed_retry="seed_retry",
+    )
+    payment = LightClientPayment(
+        light_client_address=light_client_address,
+        partner_address=factories.make_checksum_address(),
+        is_lc_initiator=1,
+        token_network_id=factories.make_checksum_address(),
+        amount=10,
+        created_on=datetime.utcnow().isoformat(),
+        payment_status=LightClientPaymentStatus.InProgress,
+        identifier="1",
+    )
+    storage.write_light_client_payment(payment)
+
+    def make_msg_dto(order):
+        return DbLightClientProtocolMessage(
+            LightClientProtocolMessage(
+                is_signed=True,
+                message_order=order,
+                light_client_payment_id=payment.payment_id,
+                identifier="42",
+                signed_message='{"type": "Processed"}',
+            )
+        )
+
+    assert storage._insert_light_client_protocol_message_if_absent(make_msg_dto(order=3))
+    assert not storage._insert_light_client_protocol_message_if_absent(make_msg_dto(order=3))
+    assert storage.is_light_client_protocol_message_already_stored_with_message_id(42, 1, 3)
+
+    # Same message identifier, different order in the payment
+    assert storage._insert_light_client_protocol_message_if_absent(make_msg_dto(order=4))